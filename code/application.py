@@ -1,21 +1,46 @@
 import os
-import requests
+import requests_cache
+from requests_cache import DO_NOT_CACHE, RedisCache, create_key
+from requests.adapters import HTTPAdapter
 import urllib.parse
-from flask import Flask, redirect, request, session, url_for, render_template
+from flask import Flask, redirect, request, session, url_for, render_template, jsonify
+from flask_session import Session
+import redis
 import certifi
+import orjson
 import boto3
-import io
-import csv
-import datetime
+from botocore.client import Config
+from botocore.exceptions import ClientError
+import hashlib
+import heapq
+from collections import Counter
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+import time
 
 application = Flask(__name__)
-application.secret_key = os.urandom(24)  # needed for session
+# needed for session; must be stable across restarts / instances so existing
+# sessions stay valid (set as an EB environment property)
+application.secret_key = os.environ["FLASK_SECRET_KEY"]
+
+# Keep session data (tokens, expiry) in Redis; the cookie only carries the session id.
+# REDIS_URL must point at a shared Redis (e.g. ElastiCache) - nothing runs one locally on EB
+redis_client = redis.Redis.from_url(os.environ["REDIS_URL"])
+application.config.update(
+    SESSION_TYPE="redis",
+    SESSION_REDIS=redis_client,
+)
+Session(application)
 
 # Your S3 bucket name (set in env variable or fallback to default)
 S3_BUCKET = os.getenv("S3_BUCKET", "spotify-stats-reports-123")
 
 # Boto3 S3 client (will use IAM role attached to EB EC2 instance)
-s3_client = boto3.client("s3")
+# Created once so every export shares the same keep-alive connection pool
+s3_client = boto3.client(
+    "s3",
+    config=Config(max_pool_connections=50, retries={"max_attempts": 3}),
+)
 
 # Spotify API credentials (from Spotify Developer Dashboard)
 CLIENT_ID = os.getenv("CLIENT_ID")
@@ -27,9 +52,132 @@ SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
 SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
 SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1"
 
+# Fixed parts of Spotify requests, built once instead of per call
+TOKEN_BASE = {
+    "grant_type": "authorization_code",
+    "redirect_uri": REDIRECT_URI,
+    "client_id": CLIENT_ID,
+    "client_secret": CLIENT_SECRET,
+}
+REFRESH_BASE = {
+    "grant_type": "refresh_token",
+    "client_id": CLIENT_ID,
+    "client_secret": CLIENT_SECRET,
+}
+RECENT_URL = f"{SPOTIFY_API_BASE_URL}/me/player/recently-played?limit=50"
+TOP_TRACKS_TMPL = SPOTIFY_API_BASE_URL + "/me/top/tracks?limit={limit}&time_range={time_range}"
+TOP_ARTISTS_TMPL = SPOTIFY_API_BASE_URL + "/me/top/artists?limit={limit}&time_range={time_range}"
+TOP_TMPLS = {"tracks": TOP_TRACKS_TMPL, "artists": TOP_ARTISTS_TMPL}
+
+# How long Spotify top-* results stay fresh; short_term moves fastest
+TOP_CACHE_TTLS = {"short_term": 60, "medium_term": 300, "long_term": 3600}
+
+
+def _cache_key(request, **kwargs):
+    # Keep users' cached responses apart without storing the bearer token:
+    # requests-cache redacts Authorization, so mix in a hash of it instead
+    auth = request.headers.get("Authorization", "")
+    auth_hash = hashlib.sha256(auth.encode("utf-8")).hexdigest()[:16]
+    return f"{create_key(request, **kwargs)}_{auth_hash}"
+
+
+# Shared HTTP session so every Spotify / Lambda call reuses keep-alive connections.
+# GETs are cached in Redis for the per-time-range TTLs above (Spotify sends
+# "Cache-Control: private, max-age=0", so its headers are ignored) and Redis
+# expires the keys itself. Each user's token is hashed into the cache key so
+# users never see each other's data.
+SPOTIFY_SESSION = requests_cache.CachedSession(
+    backend=RedisCache(namespace="spotify_http", connection=redis_client),
+    expire_after=300,
+    urls_expire_after={
+        "api.spotify.com/v1/me/player/*": DO_NOT_CACHE,
+        "api.spotify.com/v1/me/top/*time_range=short_term*": TOP_CACHE_TTLS["short_term"],
+        "api.spotify.com/v1/me/top/*time_range=medium_term*": TOP_CACHE_TTLS["medium_term"],
+        "api.spotify.com/v1/me/top/*time_range=long_term*": TOP_CACHE_TTLS["long_term"],
+    },
+    cache_control=False,
+    key_fn=_cache_key,
+)
+SPOTIFY_SESSION.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50))
+# CA bundle resolved once at import; scoped to this session so boto3 keeps its own
+SPOTIFY_SESSION.verify = certifi.where()
+
 # Scopes you want (adjust depending on your use case)
 SCOPE = "user-read-recently-played user-top-read"
 
+# Authorize URL only depends on constants, so build it once
+LOGIN_URL = f"{SPOTIFY_AUTH_URL}?" + urllib.parse.urlencode({
+    "client_id": CLIENT_ID,
+    "response_type": "code",
+    "redirect_uri": REDIRECT_URI,
+    "scope": SCOPE,
+    "show_dialog": "true"   # 👈 forces re-login each time
+})
+
+
+# Spotify's max page size; fetched once and sliced for /stats (10) and /export (20)
+TOP_FETCH_LIMIT = 50
+
+def _fetch_top(headers, kind, time_range, limit=TOP_FETCH_LIMIT):
+    # kind is "tracks" or "artists"
+    resp = SPOTIFY_SESSION.get(
+        TOP_TMPLS[kind].format(limit=limit, time_range=time_range),
+        headers=headers
+    )
+    return orjson.loads(resp.content)
+
+
+def _fetch_top_both(headers, time_range, limit=TOP_FETCH_LIMIT):
+    # Fire both Spotify calls at once instead of waiting on each in turn;
+    # both threads share SPOTIFY_SESSION's connection pool
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_tracks = ex.submit(_fetch_top, headers, "tracks", time_range, limit)
+        f_artists = ex.submit(_fetch_top, headers, "artists", time_range, limit)
+        return f_tracks.result(), f_artists.result()
+
+
+def _slice_items(resp, limit):
+    return {**resp, "items": resp.get("items", [])[:limit]}
+
+
+def get_top(token, time_range, limit):
+    # One limit=50 fetch serves both /stats and /export; repeats within the
+    # TTL are answered from SPOTIFY_SESSION's shared Redis cache
+    headers = {"Authorization": f"Bearer {token}"}
+    tracks_resp, artists_resp = _fetch_top_both(headers, time_range)
+    return _slice_items(tracks_resp, limit), _slice_items(artists_resp, limit)
+
+
+def get_valid_token():
+    # Refresh the access token silently when it's about to expire,
+    # instead of sending the user through the whole OAuth flow again
+    token = session.get("access_token")
+    if not token:
+        return None
+
+    if time.time() < session.get("expires_at", 0) - 60:
+        return token
+
+    refresh_token = session.get("refresh_token")
+    if not refresh_token:
+        return None
+
+    token_response = SPOTIFY_SESSION.post(
+        SPOTIFY_TOKEN_URL, data={**REFRESH_BASE, "refresh_token": refresh_token}
+    )
+    if token_response.status_code != 200:
+        return None
+    token_json = orjson.loads(token_response.content)
+
+    session["access_token"] = token_json["access_token"]
+    session["expires_at"] = time.time() + token_json.get("expires_in", 3600)
+    # Spotify may rotate the refresh token
+    if token_json.get("refresh_token"):
+        session["refresh_token"] = token_json["refresh_token"]
+
+    return session["access_token"]
+
+
 @application.route("/")
 def index():
     return render_template("login.html")
@@ -37,15 +185,7 @@ def index():
 
 @application.route("/login")
 def login():
-    params = {
-        "client_id": CLIENT_ID,
-        "response_type": "code",
-        "redirect_uri": REDIRECT_URI,
-        "scope": SCOPE,
-        "show_dialog": "true"   # 👈 forces re-login each time
-    }
-    url = f"{SPOTIFY_AUTH_URL}?{urllib.parse.urlencode(params)}"
-    return redirect(url)
+    return redirect(LOGIN_URL)
 
 
 @application.route("/callback")
@@ -56,54 +196,46 @@ def callback():
         return "Authorization failed.", 400
 
     # Step 3. Exchange code for access token
-    token_data = {
-        "grant_type": "authorization_code",
-        "code": code,
-        "redirect_uri": REDIRECT_URI,
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-    }
-    token_response = requests.post(SPOTIFY_TOKEN_URL, data=token_data, verify=certifi.where())
-    token_json = token_response.json()
+    token_data = {**TOKEN_BASE, "code": code}
+    token_response = SPOTIFY_SESSION.post(SPOTIFY_TOKEN_URL, data=token_data)
+    token_json = orjson.loads(token_response.content)
 
     # Save tokens in session
     session["access_token"] = token_json.get("access_token")
     session["refresh_token"] = token_json.get("refresh_token")
+    session["expires_at"] = time.time() + token_json.get("expires_in", 3600)
 
     return redirect(url_for("stats"))
 
 
 @application.route("/stats")
 def stats():
-    token = session.get("access_token")
+    token = get_valid_token()
     if not token:
         return redirect(url_for("login"))
 
     # Get chosen time range, default = medium_term
     time_range = request.args.get("time_range", "medium_term")
 
-    headers = {"Authorization": f"Bearer {token}"}
-
-    # Top tracks
-    tracks_resp = requests.get(
-        f"{SPOTIFY_API_BASE_URL}/me/top/tracks?limit=10&time_range={time_range}",
-        headers=headers, verify=certifi.where()
-    ).json()
+    # Top tracks + top artists (shared with /export)
+    tracks_resp, artists_resp = get_top(token, time_range, 10)
 
-    top_tracks = [
-        {
+    # Top tracks and top albums (derived from tracks' album info) in one pass
+    top_tracks = []
+    album_counts = Counter()
+    album_meta = {}
+    for t in tracks_resp.get("items", []):
+        album = t["album"]
+        album_id = album["id"]
+        image = album["images"][0]["url"] if album["images"] else None
+        top_tracks.append({
             "name": t["name"],
-            "artist": ", ".join([a["name"] for a in t["artists"]]),
-            "image": t["album"]["images"][0]["url"] if t["album"]["images"] else None
-        }
-        for t in tracks_resp.get("items", [])
-    ]
-
-    # Top artists
-    artists_resp = requests.get(
-        f"{SPOTIFY_API_BASE_URL}/me/top/artists?limit=10&time_range={time_range}",
-        headers=headers, verify=certifi.where()
-    ).json()
+            "artist": ", ".join(a["name"] for a in t["artists"]),
+            "image": image
+        })
+        album_counts[album_id] += 1
+        if album_id not in album_meta:
+            album_meta[album_id] = {"name": album["name"], "image": image}
 
     top_artists = [
         {
@@ -113,20 +245,10 @@ def stats():
         for a in artists_resp.get("items", [])
     ]
 
-    # Top albums → derive from tracks’ album info
-    albums = {}
-    for t in tracks_resp.get("items", []):
-        album = t["album"]
-        album_id = album["id"]
-        if album_id not in albums:
-            albums[album_id] = {
-                "name": album["name"],
-                "image": album["images"][0]["url"] if album["images"] else None,
-                "count": 0
-            }
-        albums[album_id]["count"] += 1
-
-    top_albums = sorted(albums.values(), key=lambda x: x["count"], reverse=True)[:10]
+    top_albums = [
+        {**album_meta[album_id], "count": count}
+        for album_id, count in heapq.nlargest(10, album_counts.items(), key=itemgetter(1))
+    ]
 
     return render_template(
         "stats.html",
@@ -144,20 +266,39 @@ def logout():
 
 API_GATEWAY_URL = "https://uvdf0v98lb.execute-api.us-west-2.amazonaws.com/userstats"
 
+# Recently-played stats are computed in-process; set USE_LAMBDA_STATS=1 to go
+# back to the API Gateway → Lambda round-trip
+USE_LAMBDA_STATS = os.getenv("USE_LAMBDA_STATS", "0") == "1"
+
+
+def compute_recent_stats(tracks, top_n=5):
+    # Same shape the Lambda returns / recently_played.html expects
+    artist_counts = Counter(t["artist"] for t in tracks)
+    album_counts = Counter(t["album"] for t in tracks)
+    day_counts = Counter(t["played_at"][:10] for t in tracks)  # ISO date part
+
+    return {
+        "top_artists": [{"name": n, "count": c} for n, c in artist_counts.most_common(top_n)],
+        "top_albums": [{"name": n, "count": c} for n, c in album_counts.most_common(top_n)],
+        "plays_per_day": [{"day": d, "count": day_counts[d]} for d in sorted(day_counts)],
+        "total": len(tracks)
+    }
+
+
 @application.route("/recently_played")
 def recently_played():
-    token = session.get("access_token")
+    token = get_valid_token()
     if not token:
         return redirect(url_for("login"))
 
     # Call Spotify API
     headers = {"Authorization": f"Bearer {token}"}
-    resp = requests.get(f"{SPOTIFY_API_BASE_URL}/me/player/recently-played?limit=50", headers=headers)
+    resp = SPOTIFY_SESSION.get(RECENT_URL, headers=headers)
 
     if resp.status_code != 200:
         return f"Error fetching Spotify data: {resp.text}"
 
-    raw_data = resp.json()
+    raw_data = orjson.loads(resp.content)
 
     # Extract artist, album, and played_at
     tracks = [{
@@ -166,57 +307,65 @@ def recently_played():
         "played_at": item["played_at"]
     } for item in raw_data.get("items", [])]
 
-    payload = {"user_id": "demo", "tracks": tracks}
+    if USE_LAMBDA_STATS:
+        payload = {"user_id": "demo", "tracks": tracks}
 
-    # Send raw data to Lambda
-    lambda_resp = requests.post(API_GATEWAY_URL, json=payload)
-    stats = lambda_resp.json()
+        # Send raw data to Lambda
+        lambda_resp = SPOTIFY_SESSION.post(
+            API_GATEWAY_URL,
+            data=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"}
+        )
+        stats = orjson.loads(lambda_resp.content)
 
-    print("Lambda response:", stats, flush=True)
+        print("Lambda response:", stats, flush=True)
+    else:
+        stats = compute_recent_stats(tracks)
 
     # Render HTML page
     return render_template("recently_played.html", stats=stats)
 
+def _csv_field(value):
+    # Quote like csv.writer's QUOTE_MINIMAL so reports stay byte-identical
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
 @application.route("/export")
 def export():
-    token = session.get("access_token")
+    token = get_valid_token()
     if not token:
         return redirect(url_for("login"))
 
     # ✅ carry over the time_range from query string
     time_range = request.args.get("time_range", "medium_term")
 
-    headers = {"Authorization": f"Bearer {token}"}
-
-    # Top tracks
-    tracks_resp = requests.get(
-        f"{SPOTIFY_API_BASE_URL}/me/top/tracks?limit=20&time_range={time_range}",
-        headers=headers
-    ).json()
+    # Top tracks + top artists (shared with /stats)
+    tracks_resp, artists_resp = get_top(token, time_range, 20)
 
-    # Top artists
-    artists_resp = requests.get(
-        f"{SPOTIFY_API_BASE_URL}/me/top/artists?limit=20&time_range={time_range}",
-        headers=headers
-    ).json()
-
-    # Convert into CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Type", "Name", "Popularity"])
-
-    for t in tracks_resp.get("items", []):
-        writer.writerow(["Track", t["name"], t["popularity"]])
-
-    for a in artists_resp.get("items", []):
-        writer.writerow(["Artist", a["name"], a["popularity"]])
-
-    csv_data = output.getvalue()
-
-    # ✅ Save to S3
-    s3_client = boto3.client("s3")
-    filename = f"spotify_report_{time_range}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
-    s3_client.put_object(Bucket=S3_BUCKET, Key=filename, Body=csv_data)
+    # Convert into CSV; fixed 3-column schema, so only names can need quoting
+    lines = ["Type,Name,Popularity"]
+    lines.extend(
+        f'Track,{_csv_field(t["name"])},{t["popularity"]}'
+        for t in tracks_resp.get("items", [])
+    )
+    lines.extend(
+        f'Artist,{_csv_field(a["name"])},{a["popularity"]}'
+        for a in artists_resp.get("items", [])
+    )
+    csv_data = ("\r\n".join(lines) + "\r\n").encode("utf-8")  # same line endings as csv.writer
+
+    # ✅ Save to S3, keyed by content so repeat exports reuse the same object
+    digest = hashlib.sha1(csv_data).hexdigest()[:12]
+    filename = f"spotify_report_{time_range}_{digest}.csv"
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET, Key=filename)
+    except ClientError as e:
+        # S3 answers 403 instead of 404 for a missing key when the role lacks s3:ListBucket
+        if e.response["Error"]["Code"] not in ("403", "404", "NoSuchKey", "NotFound", "Forbidden"):
+            raise
+        s3_client.put_object(Bucket=S3_BUCKET, Key=filename, Body=csv_data)
 
     # Generate presigned URL (valid 1h)
     url = s3_client.generate_presigned_url(
@@ -225,7 +374,16 @@ def export():
         ExpiresIn=3600
     )
 
-    return redirect(url)
+    # XHR / JSON clients get the URL directly and can fetch it themselves
+    if (request.headers.get("X-Requested-With") == "XMLHttpRequest"
+            or request.accept_mimetypes.best == "application/json"):
+        resp = jsonify({"url": url})
+    else:
+        resp = redirect(url, code=303)
+
+    # Presigned URLs are per-user and short-lived; keep them out of caches
+    resp.headers["Cache-Control"] = "no-store, max-age=0"
+    return resp
 
 # @application.route("/global_top")
 # def global_top():